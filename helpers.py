@@ -3,13 +3,42 @@
 # Date: 2021-11
 
 
-import hashlib
 import hmac
 import json
-from typing import Any
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
 import requests
 
+from requests.adapters import HTTPAdapter
 from secrets import token_hex
+from time import time
+
+# orjson is optional, it serializes request bodies faster than the standard
+# json module. Both return something requests can send as a body.
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_dumps = json.dumps
+
+
+# A single session is shared by every request made to Twitch so that
+# connections to id.twitch.tv and api.twitch.tv are kept alive and reused
+# instead of doing a new TCP and TLS handshake for every call.
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+
+# Define a function that returns the shared HTTP session.
+def get_session() -> requests.Session:
+    '''
+    Gets the requests session shared by all calls to the Twitch API.
+
+    Returns:
+        _SESSION (requests.Session): The shared session.
+    '''
+    return _SESSION
 
 
 # Define a function that initiates the OIDC Authorization Code Flow process.
@@ -40,16 +69,25 @@ def authorize(callback: str, client_id: str) -> str:
         f'&state={state}'
 
     print(f'AUTHORIZATION URL: {auth_url}\n')
-    response = requests.get(auth_url)
+    response = _SESSION.get(auth_url)
     print(f'RESPONSE: {response.headers}\n{response.json}')
 
     return state
 
 
+# The current app access token and the time (epoch seconds) it expires. The
+# token is also saved to disk so that restarting the bot does not require a
+# new one while the saved token is still valid.
+_TOKEN = {'client_id': None, 'value': None, 'exp': 0}
+_TOKEN_PATH = os.path.join(os.path.expanduser('~'), '.cb2_bot', 'token.json')
+
+
 # Define a function to get an app access token used for subscribing to EventSub topics.
-def get_app_access_token(client_id: str, secret: str) -> str:
+def get_app_access_token(client_id: str, secret: str) -> Optional[str]:
     '''
-    Gets an app access token from Twitch.
+    Gets an app access token from Twitch. The token is cached in memory and
+    on disk, and a new one is only requested when the cached token is missing
+    or within a minute of expiring.
 
     Parameters:
         client_id (str): The client ID of the application or extension using
@@ -58,35 +96,109 @@ def get_app_access_token(client_id: str, secret: str) -> str:
                       function.
 
     Returns:
-        access_token (str): An app access token from Twitch.
+        access_token (str): An app access token from Twitch, or None if one
+                            could not be obtained.
     '''
+    if _TOKEN['client_id'] == client_id and time() < _TOKEN['exp'] - 60:
+        return _TOKEN['value']
+
+    # Try a token saved by a previous run before asking Twitch for a new one.
+    try:
+        with open(_TOKEN_PATH) as token_file:
+            saved = json.load(token_file)
+        if saved['client_id'] == client_id and time() < saved['exp'] - 60:
+            _TOKEN.update(client_id=client_id, value=saved['value'], exp=saved['exp'])
+            return _TOKEN['value']
+    except (OSError, ValueError, KeyError):
+        pass
+
     request_dict = {
         'client_id': client_id,
         'client_secret': secret,
         'grant_type': 'client_credentials'
     }
 
-    response = requests.post("https://id.twitch.tv/oauth2/token", data=request_dict)
-    json_data = json.loads(response.text)
-    access_token = json_data["access_token"]
+    # Errors are printed rather than raised, since this is called from chat
+    # command handlers and must not stop the bot.
+    try:
+        response = _SESSION.post("https://id.twitch.tv/oauth2/token", data=request_dict)
+        json_data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        print(f'Could not get app access token: {e}\n')
+        return None
+
+    if not response.ok or 'access_token' not in json_data:
+        print(f'Could not get app access token ({response.status_code}): {response.text}\n')
+        return None
+
+    _TOKEN.update(client_id=client_id, value=json_data["access_token"],
+                  exp=time() + json_data["expires_in"])
+
+    # Save the token, readable only by the current user.
+    try:
+        os.makedirs(os.path.dirname(_TOKEN_PATH), exist_ok=True)
+        fd = os.open(_TOKEN_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as token_file:
+            json.dump(_TOKEN, token_file)
+    except OSError as e:
+        print(f'Could not save app access token: {e}\n')
+
+    return _TOKEN['value']
+
+
+# Define a function that throws away the cached app access token, so that the
+# next call to get_app_access_token() requests a new one.
+def clear_app_access_token() -> None:
+    '''
+    Clears the cached app access token from memory and disk. Called when
+    Twitch rejects the token (HTTP 401).
 
-    return access_token
+    Returns:
+        Nothing returned.
+    '''
+    _TOKEN.update(client_id=None, value=None, exp=0)
+    try:
+        os.remove(_TOKEN_PATH)
+    except FileNotFoundError:
+        pass
 
 
-# Define a function to get data on a twtich user account and return it as JSON.
-def get_user_data(username: str, auth: str) -> Any:
+# Define a function that checks a Twitch API response for a rejected token.
+def _check_token(response: requests.Response) -> bool:
+    '''
+    Clears the cached app access token if Twitch rejected it, so that the
+    next call gets a new one.
+
+    Parameters:
+        response (requests.Response): A response from the Twitch API.
+
+    Returns:
+        Boolean: True if the token was accepted, False if it was rejected.
+    '''
+    if response.status_code == 401:
+        clear_app_access_token()
+        return False
+
+    return True
+
+
+# Define a function to get data on a twitch user account (from the Helix API)
+# and return it as JSON.
+def get_user_data(username: str, auth: dict) -> Any:
     '''
     Gets a user object from Twitch.
 
     Parameters:
         username (str): A Twitch username.
-        auth (dict): A Twitch OAuth token.
+        auth (dict): Request headers with the application's client ID and an
+                     app access token.
 
     Returns:
         response (JSON): A Twitch user object in JSON format.
     '''
-    request = 'https://api.twitch.tv/kraken/users?login='+username
-    response = requests.get(request, None, headers=auth)
+    request = 'https://api.twitch.tv/helix/users?login='+username
+    response = _SESSION.get(request, headers=auth)
+    _check_token(response)
 
     return response.json()
 
@@ -104,19 +216,30 @@ def nuke_eventsubs(access_token: str, client_id: str) -> bool:
                          this function.
 
     Returns:
-        Boolean (True) upon completion.
+        Boolean: True upon completion, False if the access token was
+                 rejected.
     '''
     headers = {'Client-ID': client_id, 
             'Authorization': 'Bearer ' + access_token}
 
-    response = requests.get(url='https://api.twitch.tv/helix/eventsub/subscriptions', headers=headers)
+    response = _SESSION.get(url='https://api.twitch.tv/helix/eventsub/subscriptions', headers=headers)
+    if not _check_token(response):
+        print("Could not list subscriptions, app access token rejected.\n")
+        return False
     print(f"Subscriptions: {response.json()}\n")
     subs_json = response.json()
-    for i in subs_json['data']:
-        print(f"Unsubbing ID: {i['id']}")
 
-        requests.delete(url=f'https://api.twitch.tv/helix/eventsub/subscriptions?id={i["id"]}',
-                        headers=headers)
+    # Send a delete request for a single subscription and report failures.
+    def unsub(sub: dict) -> None:
+        print(f"Unsubbing ID: {sub['id']}")
+        response = _SESSION.delete(url=f'https://api.twitch.tv/helix/eventsub/subscriptions?id={sub["id"]}',
+                                   headers=headers)
+        if not response.ok:
+            print(f"Failed to unsub ID: {sub['id']} ({response.status_code}): {response.text}\n")
+
+    # The deletes are independent, so send them in parallel over the shared session.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(unsub, subs_json['data']))
 
     return True
 
@@ -157,14 +280,15 @@ def subscribe_to_eventsub(access_token: str, callback: str, client_id: str, secr
         }
     }
     # Package json for request and send to begin a new EventSub.
-    json_data = json.dumps(data)
+    json_data = _json_dumps(data)
     headers = {'Client-ID': client_id, 
                'Authorization': f'Bearer {access_token}', 
                'Content-Type': 'application/json'
               }
-    response = requests.post(url='https://api.twitch.tv/helix/eventsub/subscriptions', 
-                            data=json_data, headers=headers)
+    response = _SESSION.post(url='https://api.twitch.tv/helix/eventsub/subscriptions', 
+                             data=json_data, headers=headers)
     print(f'Sub Request Response: {response.text}\n')
+    _check_token(response)
 
 
 # Define a function that verifies the signature of an EventSub POST response from Twitch.
@@ -172,14 +296,14 @@ def subscribe_to_eventsub(access_token: str, callback: str, client_id: str, secr
 # 
 #   This function will return True if the signature is verified, and
 #   will return False if the signatures do not match.
-def verify_signature(secret: str, es_id: str, es_timestamp: str, es_body_bytes: bytes, es_sig: str) -> bool:
+def verify_signature(secret: bytes, es_id: str, es_timestamp: str, es_body_bytes: bytes, es_sig: str) -> bool:
     '''
     Verifies the signature of an EventSub POST response from Twitch by
     calculating a HMAC-SHA256 signature and comparing it to the signature
     sent by Twitch.
 
     Parameters:
-        secret (str): The application's secret.
+        secret (bytes): The application's secret, already encoded to bytes.
         es_id (str): The ID of the message from Twitch.
         es_timestamp (str): The timestamp of the message from Twitch.
         es_body_bytes (bytes): The entire body of the message from Twitch.
@@ -189,9 +313,17 @@ def verify_signature(secret: str, es_id: str, es_timestamp: str, es_body_bytes:
         Boolean: True if the signature is verified (signatures match),
                  False if the signatures do not match.
     '''
-    # Assemble the message that will be encoded for comparison to the Twitch signature.
-    hmac_msg = es_id.encode() + es_timestamp.encode() + es_body_bytes
-    # Calculate an HMAC-SHA256 string from the assembled message.
-    calculated_signature = hmac.new(key=secret.encode(), msg=hmac_msg, digestmod=hashlib.sha256).hexdigest()
-    # If the signatures match, return True.
-    return bool(calculated_signature == es_sig.removeprefix('sha256='))
+    # Feed the message parts to the HMAC one at a time rather than joining them
+    # first, so no temporary copy of the (possibly large) body is made.
+    mac = hmac.new(secret, digestmod='sha256')
+    mac.update(es_id.encode())
+    mac.update(es_timestamp.encode())
+    mac.update(es_body_bytes)
+    calculated_signature = mac.digest()
+    # Twitch sends the signature as a hex string, convert it back to raw bytes.
+    try:
+        expected_signature = bytes.fromhex(es_sig.removeprefix('sha256='))
+    except ValueError:
+        return False
+    # If the signatures match, return True. Use a constant-time comparison.
+    return hmac.compare_digest(calculated_signature, expected_signature)
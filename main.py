@@ -10,24 +10,26 @@
 # TODO: Add functionality for other EventSub topics (currently only follow,
 #       subscribe, and cheer are supported)
 
+import collections
+import functools
 import json
 import os
-import requests
+import re
 import schedule
+import selectors
 import socket
 import sqlite3
 import threading
 import logging
-import urllib.parse as urlparse
 
 from dotenv import load_dotenv
-from helpers import (authorize, get_app_access_token, get_user_data, 
-                    nuke_eventsubs, subscribe_to_eventsub,
+from helpers import (authorize, get_app_access_token, get_session,
+                    get_user_data, nuke_eventsubs, subscribe_to_eventsub,
                     verify_signature)
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from os.path import join, dirname
 from time import time
-from urllib.parse import parse_qs
+from urllib.parse import parse_qsl
 
 
 # Load environment variables.
@@ -43,40 +45,55 @@ BOT_USERNAME        = os.environ['BOT_USERNAME']
 CALLBACK            = os.environ['CALLBACK']
 CHANNEL             = f'#{os.environ["CHANNEL"]}'
 CLIENT_ID           = os.environ['CLIENT_ID']
-AUTH                = {'Accept': 'application/vnd.twitchtv.v5+json',
-                       'Client-ID': CLIENT_ID}
-COOLDOWN            = os.environ['COOLDOWN']
+COOLDOWN            = int(os.environ['COOLDOWN'])
 DB                  = os.path.join(__location__, os.environ['DB'])
 ENDPOINT            = 'https://api.twitch.tv/helix/eventsub/subscriptions'
 HTTP_PORT           = int(os.environ['HTTP_PORT'])
 IRC_CONNECTION_DATA = ('irc.chat.twitch.tv', 6667)
 OAUTH               = f'oauth:{os.environ["OAUTH"]}'
 SECRET              = os.environ['SECRET']
-APP_ACCESS_TOKEN    = get_app_access_token(CLIENT_ID, SECRET)
+# Encoded once here since it is needed as bytes for every EventSub signature check.
+SECRET_BYTES        = SECRET.encode()
 
-# This list contains all users that will be able to execute certain chat 
+# This set contains all users that will be able to execute certain chat 
 # commands that should only be performed by moderators. Names will be 
-# checked against this list before executing such commands.
-MODS = os.environ['MODS']
+# checked against this set (lowercased) before executing such commands.
+# Brackets and quotes are stripped so a Python style list still works.
+MODS = frozenset(mod for m in os.environ['MODS'].split(',')
+                 if (mod := m.strip(' \'"[]').lower()))
+
+# SQL statements used on the commands table. Keeping the text identical between
+# calls lets sqlite3 reuse its cached prepared statements.
+SQL_SELECT_CMD = 'SELECT command, content, mod FROM commands WHERE command = ?'
+SQL_INSERT_CMD = 'INSERT INTO commands (command, content, mod) VALUES (?, ?, ?)'
+SQL_DELETE_CMD = 'DELETE FROM commands WHERE command = ?'
 
 # Define a list of phrases to respond to as a greeting.
 GREETINGS = ['hi', 'hello', 'heyo', 'yo', 'hey', 'salut', 'suh']
-# Define a list of users that have said one of the 'hello' variations already.
-seen_users = []
+# Match any of the greetings as a whole word (so 'this' does not match 'hi').
+GREETING_RE = re.compile(r'\b(?:' + '|'.join(GREETINGS) + r')\b', re.IGNORECASE)
+# Define a set of users that have said one of the 'hello' variations already.
+seen_users = set()
 # Defina a dictionary that will store instances of the CooldownHandler class.
 # Every command will get its own instance of the class.
 cooldown_handlers = {}
 
+# IRC lines that are sent often, encoded once here instead of on every send.
+PRIVMSG_PREFIX = f'PRIVMSG {CHANNEL} :'.encode()
+PONG_BYTES     = b'PONG :tmi.twitch.tv\r\n'
+
 # Create a socket object and make a connection to the chat ircserver.
 ircserver = socket.socket()
 ircserver.connect(IRC_CONNECTION_DATA)
 
 # Tell the ircserver who we are.
-ircserver.send(bytes('PASS {}\r\n'.format(OAUTH), 'UTF-8'))
-ircserver.send(bytes('NICK {}\r\n'.format(BOT_USERNAME), 'UTF-8'))
+ircserver.send(f'PASS {OAUTH}\r\n'.encode())
+ircserver.send(f'NICK {BOT_USERNAME}\r\n'.encode())
 
-# This list will hold all previously seen Twitch-Eventsub-Message-Id values.
-seen_message_ids = []
+# This ordered dict will hold the most recently seen Twitch-Eventsub-Message-Id
+# values (as keys), oldest first, so the oldest can be dropped once it is full.
+seen_message_ids = collections.OrderedDict()
+SEEN_MESSAGE_IDS_MAX = 4096
 
 
 # Define a class that will keep track of when a command was last used and
@@ -116,7 +133,7 @@ class CooldownHandler:
             length of cooldown in seconds
         '''
         self.command = command
-        self.cooldown = int(cooldown)
+        self.cooldown = cooldown
         self.last_used = time()
 
     def is_useable(self) -> bool:
@@ -156,13 +173,19 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_GET(self):
-        parsed = urlparse.urlparse(self.path).query
+        # Everything after the first '?' is the query string.
+        parsed = self.path.partition('?')[2]
         print(f'PARSED: {parsed}\n')
 
         # Handle GET requests from Twitch
         try:
-            code = parse_qs(parsed)['code'][0]
-            state = parse_qs(parsed)['state'][0]
+            # The callback only carries a few fields, so cap how many are parsed
+            # (parse_qsl raises ValueError past the limit).
+            # A KeyError here means this is not an OAuth callback, so it is
+            # answered like any other GET request below.
+            params = dict(parse_qsl(parsed, max_num_fields=8))
+            code = params['code']
+            state = params['state']
             print(f'STATE: {state}\n')
             print(f'LOCAL STATE: {os.environ["STATE"]}\n')
             print(f'CODE: {code}\n')
@@ -176,7 +199,7 @@ class RequestHandler(BaseHTTPRequestHandler):
                     'redirect_uri': CALLBACK
                 }
 
-                response = requests.post('https://id.twitch.tv/oauth2/token', request_dict)
+                response = get_session().post('https://id.twitch.tv/oauth2/token', request_dict)
                 print(f'RESPONSE: {response}\n')
 
                 self._set_response()
@@ -185,6 +208,7 @@ class RequestHandler(BaseHTTPRequestHandler):
             else:
                 self.send_response(403)
                 self.end_headers()
+                return
 
         except:
             pass
@@ -200,10 +224,11 @@ class RequestHandler(BaseHTTPRequestHandler):
                 str(self.path), str(self.headers), post_data.decode('utf-8'))
 
         # This section will handle POST requests that come from Twitch.
-        if self.headers['Twitch-Eventsub-Message-Id']:
-            message_id = self.headers['Twitch-Eventsub-Message-Id']
-            eventsub_timestamp = self.headers['Twitch-Eventsub-Message-Timestamp']
-            eventsub_signature = self.headers['Twitch-Eventsub-Message-Signature']
+        headers = self.headers
+        if message_id := headers['Twitch-Eventsub-Message-Id']:
+            eventsub_timestamp = headers['Twitch-Eventsub-Message-Timestamp']
+            eventsub_signature = headers['Twitch-Eventsub-Message-Signature']
+            message_type = headers['Twitch-Eventsub-Message-Type']
 
             # Return a 200 status if the message ID has been seen before.
             if message_id in seen_message_ids:
@@ -211,12 +236,14 @@ class RequestHandler(BaseHTTPRequestHandler):
                 print(f'Previously seen message ID: {message_id}, returning 200.\n')
 
             # Verify that the request came from Twitch.
-            elif verify_signature(SECRET, message_id, eventsub_timestamp, post_data, eventsub_signature) == True:                      
-                seen_message_ids.append(message_id)
+            elif verify_signature(SECRET_BYTES, message_id, eventsub_timestamp, post_data, eventsub_signature) == True:                      
+                seen_message_ids[message_id] = None
+                if len(seen_message_ids) > SEEN_MESSAGE_IDS_MAX:
+                    seen_message_ids.popitem(last=False)
                 payload = json.loads(post_data)
 
                 # If the message is a webhook verification, return the challenge.
-                if self.headers['Twitch-Eventsub-Message-Type'] == 'webhook_callback_verification':
+                if message_type == 'webhook_callback_verification':
                     eventsub_challenge = payload['challenge']
                     challenge_bytes = eventsub_challenge.encode()
                     self.send_response(200)
@@ -225,9 +252,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                     self.wfile.write(challenge_bytes)
 
                 # If the message is a notification, take the appropriate action.
-                elif self.headers['Twitch-Eventsub-Message-Type'] == 'notification':
-                    subscription_type = self.headers['Twitch-Eventsub-Subscription-Type']
-                    user_name = payload['event']['user_name']
+                elif message_type == 'notification':
+                    subscription_type = headers['Twitch-Eventsub-Subscription-Type']
+                    event = payload.get('event', {})
+                    user_name = event.get('user_name')
 
                     # If someone followed, thank them in chat.
                     if subscription_type == 'channel.follow':
@@ -236,14 +264,14 @@ class RequestHandler(BaseHTTPRequestHandler):
 
                     # If someone subscribed, thank them in chat.
                     elif subscription_type == 'channel.subscribe':
-                        sub_tier = int(int(payload['event']['tier']) / 1000)
+                        sub_tier = int(int(event['tier']) / 1000)
                         sendmsg(f'{user_name} subscribed at tier {sub_tier}! Thank you for the support!')
                         self._set_response()
 
                     # If someone cheered, thank them in chat.
                     elif subscription_type == 'channel.cheer':
-                        bits = payload['event']['bits']
-                        if payload['event']['is_anonymous'] == False:
+                        bits = event['bits']
+                        if event['is_anonymous'] == False:
                             sendmsg(f'{user_name} cheered {bits} bits! Thank you for the support!')
                         else:
                             sendmsg(f'Anonymous cheered {bits} bits! Thank you for the support!')
@@ -280,9 +308,8 @@ thread.daemon = True
 
 
 # Define a function that adds a command to the database if it doesn't already exist.
-def add_command(message: str, cursor: sqlite3.Cursor):
-    # Split the message into a list.
-    splitmsg = message.split(' ')
+# The message is passed in already split on spaces (see command()).
+def add_command(splitmsg: list, cursor: sqlite3.Cursor):
     # Check if this is to be a mod-only command (the 'mod' flag will be provided after the
     # command name, which will be at index 2).
     if splitmsg[1].lower() == 'mod':
@@ -301,18 +328,16 @@ def add_command(message: str, cursor: sqlite3.Cursor):
         content = ' '.join(splitmsg[2:])
 
     # Check if the command already exists.
-    cursor.execute('SELECT command FROM commands WHERE command = :command',
-                  {'command': command})
+    cursor.execute(SQL_SELECT_CMD, (command,))
     # Insert the new command if it doesn't already exist.
     if cursor.fetchone() == None:
-        cursor.execute('INSERT INTO commands (command, content, mod) VALUES (?, ?, ?)',
-                        (command, content, mod))
+        cursor.execute(SQL_INSERT_CMD, (command, content, mod))
         return True
 
     return False
 
 
-# Schedule a job to clear out the seen_users list every day at midnight.
+# Schedule a job to clear out the seen_users set every day at midnight.
 def clear_seen_users():
     seen_users.clear()
     sendmsg('/me Seen users list cleared!')
@@ -322,15 +347,14 @@ def clear_seen_users():
 def command_handler(command: str, user: str, cursor: sqlite3.Cursor) -> str:
     # Try/except in case of sqlite3 error on query executon.
     try:
-        cursor.execute('SELECT command, content, mod FROM commands WHERE command = :command',
-                      {'command': command})
+        cursor.execute(SQL_SELECT_CMD, (command,))
         row = cursor.fetchone()
         # Check if nothing was returned, meaning no command was found.
         if row == None:
             return None
 
         # Return any command if the user is a mod.
-        if user in MODS:
+        if user.lower() in MODS:
             return row[1]
 
         # Non-mod commands are usable by anyone, but are subject to cooldowns.
@@ -365,9 +389,12 @@ def command_handler(command: str, user: str, cursor: sqlite3.Cursor) -> str:
 def command(message: str, name: str, cursor: sqlite3.Cursor, dbconnection: sqlite3.Connection):
     # Remove the leading !, save this in case it's a new command that needs added to the DB.
     message = message[1:]
-    # Split the message on spaces and get just the first part (the command name).
-    cmd = message.split(' ')[0]
+    # Split the message on spaces once, the first part is the command name.
+    # At most 4 parts are needed ('addcom', 'mod', name, contents).
+    splitmsg = message.split(' ', 3)
+    cmd = splitmsg[0]
     print(f'Command {cmd} received, issued by user {name}\n')
+    is_mod = name.lower() in MODS
 
     # This handles execution of all commands that are stored in the database.
     # Used the walrus operator for simplicity.
@@ -386,51 +413,57 @@ def command(message: str, name: str, cursor: sqlite3.Cursor, dbconnection: sqlit
     # according to estimated frequency of use.
 
     # Shoutout command for referring viewers to other streamers.
-    elif cmd == 'so' and name in MODS:
-        shoutout = message.split(' ')[1]
+    elif cmd == 'so' and is_mod:
+        shoutout = splitmsg[1]
         sendmsg(f'Check out {shoutout} at https://twitch.tv/{shoutout} !')
 
     # Adds a new command to the database.
-    elif cmd == 'addcom' and name in MODS:
-        if add_command(message, cursor):
+    elif cmd == 'addcom' and is_mod:
+        if add_command(splitmsg, cursor):
             dbconnection.commit()
         else:
             print(f'Failed to add command {cmd}, it may already exist.\n')
 
     # Deletes a command stored in the database.
-    elif cmd == 'delcom' and name in MODS:
-        delete_command(message, cursor)
+    elif cmd == 'delcom' and is_mod:
+        delete_command(splitmsg, cursor)
         dbconnection.commit()
 
     # Subscribes the bot to the channel's 'follow' EventSub topic.
-    elif cmd == 'esfollow' and name in MODS:
-        print('Subscribing to EventSub Follow.\n')
-        # Accessing the env variable here because the CHANNEL variable has a leading '#'.
-        subscribe_to_eventsub(APP_ACCESS_TOKEN, CALLBACK, CLIENT_ID, SECRET,
-                            get_user_id(os.environ["CHANNEL"]), 'follow')
+    # Commands needing an app access token are skipped if one can't be obtained
+    # (get_app_access_token prints the reason).
+    elif cmd == 'esfollow' and is_mod:
+        if access_token := get_app_access_token(CLIENT_ID, SECRET):
+            print('Subscribing to EventSub Follow.\n')
+            # Accessing the env variable here because the CHANNEL variable has a leading '#'.
+            subscribe_to_eventsub(access_token, CALLBACK, CLIENT_ID, SECRET,
+                                get_user_id(os.environ["CHANNEL"]), 'follow')
 
     # Subscribes the bot to the channel's 'subscribe' and 'cheer' EventSub topics.
-    elif cmd == 'essub' and name in MODS:
-        print('Subscribing to EventSub Subscribe.\n')
-        subscribe_to_eventsub(APP_ACCESS_TOKEN, CALLBACK, CLIENT_ID, SECRET,
-                            get_user_id(os.environ["CHANNEL"]), 'subscribe')
-        print('Subscribing to EventSub Cheer.\n')
-        subscribe_to_eventsub(APP_ACCESS_TOKEN, CALLBACK, CLIENT_ID, SECRET,
-                            get_user_id(os.environ["CHANNEL"]), 'cheer')
+    elif cmd == 'essub' and is_mod:
+        if access_token := get_app_access_token(CLIENT_ID, SECRET):
+            user_id = get_user_id(os.environ["CHANNEL"])
+            print('Subscribing to EventSub Subscribe.\n')
+            subscribe_to_eventsub(access_token, CALLBACK, CLIENT_ID, SECRET,
+                                user_id, 'subscribe')
+            print('Subscribing to EventSub Cheer.\n')
+            subscribe_to_eventsub(access_token, CALLBACK, CLIENT_ID, SECRET,
+                                user_id, 'cheer')
 
     # Unsubscribes the bot from all EventSub topics regardless of channel.
-    elif cmd == 'nukeeventsubs' and name in MODS:
-        print('Deleting all EventSub subscriptions.\n')
-        nuke_eventsubs(APP_ACCESS_TOKEN, CLIENT_ID)
+    elif cmd == 'nukeeventsubs' and is_mod:
+        if access_token := get_app_access_token(CLIENT_ID, SECRET):
+            print('Deleting all EventSub subscriptions.\n')
+            nuke_eventsubs(access_token, CLIENT_ID)
 
     # Disconnects the bot from Twitch chat, closes the database connection,
     # and then performs the rest of the shut down tasks.
-    elif cmd == 'disconnect' and name in MODS:
+    elif cmd == 'disconnect' and is_mod:
         dbconnection.close()
         shut_down()
 
     # Initiates the OIDC Authorization Code Flow process.
-    elif cmd == 'auth' and name in MODS:
+    elif cmd == 'auth' and is_mod:
         os.environ['STATE'] = authorize(CALLBACK, CLIENT_ID)
 
     else:
@@ -439,42 +472,90 @@ def command(message: str, name: str, cursor: sqlite3.Cursor, dbconnection: sqlit
 
 
 # Define a function that deletes a command if it exists.
-def delete_command(message: str, cursor: sqlite3.Cursor):
-    # Split the message into a list.
-    splitmsg = message.split(' ')
+# The message is passed in already split on spaces (see command()).
+def delete_command(splitmsg: list, cursor: sqlite3.Cursor):
     # Get just the command name.
     command = splitmsg[1]
-    cursor.execute('DELETE FROM commands WHERE command = :command',
-                {'command': command})
+    cursor.execute(SQL_DELETE_CMD, (command,))
 
     print(f'Command {command} deleted.\n')
 
 
-# Define a function to get a user ID specifically.
-def get_user_id(user: str, auth: dict=AUTH) -> str:
-    data = get_user_data(user, auth)
-    user_id = ''
-    for i in data['users']:
-        user_id = str(i['_id'])
+# Define a function to get a user ID specifically. Returns an empty string if
+# the user could not be found.
+def get_user_id(user: str) -> str:
+    try:
+        return lookup_user_id(user)
+    except LookupError:
+        return ''
+
+
+# Define a function that asks Twitch for a user's ID. IDs never change, so
+# results are cached to avoid asking Twitch again for the same user. Failed
+# lookups raise instead of returning, so that they are not cached.
+@functools.lru_cache(maxsize=256)
+def lookup_user_id(user: str) -> str:
+    access_token = get_app_access_token(CLIENT_ID, SECRET)
+    if access_token is None:
+        raise LookupError('No app access token to look up users with.')
+
+    headers = {'Client-ID': CLIENT_ID,
+               'Authorization': f'Bearer {access_token}'}
+    users = get_user_data(user, headers).get('data') or []
+    if not users:
+        raise LookupError(f'Twitch user {user} not found.')
+
+    return users[0]['id']
 
-    return user_id
+
+# Define a function that handles a single line received from the IRC server.
+def handle_ircmsg(ircmsg: str, cursor: sqlite3.Cursor, dbconnection: sqlite3.Connection):
+    # Respond to ircserver pings to maintain connection.
+    if ircmsg.startswith('PING '):
+        ircserver.send(PONG_BYTES)
+        print('Ping response sent.')
+
+    # Chat messages look like ':name!name@name.tmi.twitch.tv PRIVMSG #channel :message'.
+    elif len(parts := ircmsg.split(' ', 3)) == 4 and parts[1] == 'PRIVMSG':
+        name = parts[0][1:].split('!', 1)[0]
+        # Remove the leading ':' from the message.
+        message = parts[3][1:].strip()
+        print(f'Message: {message}\n')
+
+        # If message starts with a !, indicating a bot command.
+        if message.startswith('!'):
+            command(message, name, cursor, dbconnection)
+
+        # See if the user is saying hi.
+        elif GREETING_RE.search(message):
+
+            # Say hi if the user has not been seen lately.
+            if name not in seen_users:
+                sendmsg('Hi {} :)'.format(name))
+                seen_users.add(name)
 
 
 # Define a function to join a chat channel.
 def joinchan(chan: str=CHANNEL):
-    ircserver.send(bytes('JOIN {}\r\n'.format(chan), 'UTF-8'))
+    ircserver.send(f'JOIN {chan}\r\n'.encode())
     sendmsg('/me has joined the chat.')
 
 
 # Define a function to post messages in chat.
 def sendmsg(msg: str, target: str=CHANNEL):
-    ircserver.send(bytes('PRIVMSG {} :{}\r\n'.format(target, msg), 'UTF-8'))
+    # Use the prebuilt prefix for the bot's own channel.
+    if target == CHANNEL:
+        prefix = PRIVMSG_PREFIX
+    else:
+        prefix = f'PRIVMSG {target} :'.encode()
+    ircserver.send(prefix + msg.encode() + b'\r\n')
 
 
 # Define a function that shuts down the bot when called.
 def shut_down():
     print('Cancelling EventSubs and shutting down...\n')
-    nuke_eventsubs(APP_ACCESS_TOKEN, CLIENT_ID)
+    if access_token := get_app_access_token(CLIENT_ID, SECRET):
+        nuke_eventsubs(access_token, CLIENT_ID)
     sendmsg('/me goes to sleep ResidentSleeper')
     thread.join()
     exit(0)
@@ -486,42 +567,51 @@ def main():
     thread.start()
     # Connect to the bot's database and create a cursor.
     dbconnection = sqlite3.connect(DB)
+    # WAL with synchronous=NORMAL keeps !addcom/!delcom commits cheap, and the
+    # index keeps command lookups fast as the table grows.
+    dbconnection.execute('PRAGMA journal_mode=WAL')
+    dbconnection.execute('PRAGMA synchronous=NORMAL')
+    # Create the commands table first in case this is a new database.
+    dbconnection.execute('CREATE TABLE IF NOT EXISTS "commands" (id INTEGER PRIMARY KEY, '
+                         'command VARCHAR(25) NOT NULL, content VARCHAR(500) NOT NULL, '
+                         'mod INTEGER NOT NULL)')
+    dbconnection.execute('CREATE INDEX IF NOT EXISTS idx_cmd ON commands(command)')
     dbcursor = dbconnection.cursor()
     # Join the IRC channel (chat).
     joinchan()
     # Schedule the seen users list-clearing task.
     schedule.every().day.at('00:00').do(clear_seen_users)
+    # Watch the IRC socket so the loop wakes up either when data arrives or
+    # when the next scheduled job is due, whichever comes first.
+    selector = selectors.DefaultSelector()
+    selector.register(ircserver, selectors.EVENT_READ)
+    # Holds any partial IRC line left over from the previous read.
+    buffer = b''
 
     while True:
+        # Sleep until the next scheduled job, or for a minute if none are scheduled.
+        idle = schedule.idle_seconds()
+        timeout = 60 if idle is None else max(idle, 0)
+        events = selector.select(timeout)
         schedule.run_pending()
-        ircmsg = ircserver.recv(2048).decode('UTF-8')
-        ircmsg = ircmsg.strip('nr')
-        cmd = ''
-        name = ''
-
-        # Check the type of message received.
-        if ircmsg.find('PRIVMSG') != -1:
-            # strip() removes \n characters
-            name = ircmsg.split('!', 1)[0][1:].strip()
-            message = ircmsg.split('PRIVMSG', 1)[1].split(':', 1)[1].strip()
-            print(f'Message: {message}\n')
-
-            # If message starts with a !, indicating a bot command.
-            if message[0] == '!':
-                command(message, name, dbcursor, dbconnection)
-
-            # See if the user is saying hi.
-            elif any(word in message.lower() for word in GREETINGS):
-
-                # Say hi if the user has not been seen lately.
-                if name not in seen_users:
-                    sendmsg('Hi {} :)'.format(name))
-                    seen_users.append(name)
-
-        # Respond to ircserver pings to maintain connection.
-        elif ircmsg.find('PING') != -1:
-            ircserver.send(bytes('PONG :tmi.twitch.tv\r\n', 'UTF-8'))
-            print('Ping response sent.')
+        if not events:
+            continue
+
+        data = ircserver.recv(4096)
+        # An empty read means the server closed the connection. Chat can't be
+        # used any more, so clean up without calling shut_down().
+        if not data:
+            print('IRC server closed the connection, cancelling EventSubs and shutting down...\n')
+            dbconnection.close()
+            if access_token := get_app_access_token(CLIENT_ID, SECRET):
+                nuke_eventsubs(access_token, CLIENT_ID)
+            break
+
+        # TCP may split or join IRC lines, so only handle complete lines and
+        # keep the rest for the next read.
+        *lines, buffer = (buffer + data).split(b'\r\n')
+        for line in lines:
+            handle_ircmsg(line.decode('UTF-8', 'replace'), dbcursor, dbconnection)
 
 
 if __name__ == '__main__':